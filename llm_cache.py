@@ -0,0 +1,168 @@
+"""
+Caching helpers for Gemini: an on-disk response cache and server-side
+prompt prefix caching
+"""
+import google.generativeai as genai
+import asyncio
+import dataclasses
+import diskcache
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Union
+from dotenv import load_dotenv
+from google.generativeai import caching
+from pydantic import TypeAdapter, ValidationError
+
+load_dotenv()
+
+# Shared by every agent so identical prompts are only ever sent once
+cache = diskcache.Cache(os.getenv('LLM_CACHE_DIR', './.llm_cache'))
+
+# Lifetime of server-side cached prompt prefixes
+CONTEXT_CACHE_TTL = timedelta(seconds=int(os.getenv('CONTEXT_CACHE_TTL', '3600')))
+
+
+def make_key(
+        model_name: str,
+        generation_config: Union[Dict, genai.types.GenerationConfig],
+        prompt: str
+) -> str:
+    """
+    Build a content-addressed cache key for a Gemini request
+
+    Args:
+        model_name: Name of the Gemini model
+        generation_config: Generation settings sent with the request
+        prompt: Full prompt text
+
+    Returns:
+        Hex digest identifying the request
+    """
+    if dataclasses.is_dataclass(generation_config):
+        generation_config = dataclasses.asdict(generation_config)
+
+    # Key on the response schema's JSON schema so changing its fields invalidates old responses
+    if generation_config.get('response_schema') is not None:
+        generation_config = dict(
+            generation_config,
+            response_schema=TypeAdapter(generation_config['response_schema']).json_schema()
+        )
+
+    payload = f"{model_name}|{json.dumps(generation_config, sort_keys=True, default=str)}|{prompt}"
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_cached(key: str, adapter: TypeAdapter) -> Any:
+    """
+    Get a cached structured response
+
+    Args:
+        key: Cache key from make_key
+        adapter: Validator for the response; cached text that no longer
+            validates is deleted so the request is sent again
+
+    Returns:
+        Validated cached response, or None if there is no usable entry
+    """
+    response_text = cache.get(key)
+    if response_text is None:
+        return None
+
+    try:
+        return adapter.validate_json(response_text)
+    except ValidationError:
+        cache.delete(key)
+        return None
+
+
+class CachedPrefixModel:
+    # Models whose prefix could not be cached; shared by every instance so a
+    # failing create is only attempted once per process
+    _uncacheable_models = set()
+
+    def __init__(self, model_name: str, system_instruction: str, contents: List[str] = None):
+        """
+        Gemini model whose static prompt prefix is uploaded once with the
+        Context Caching API, so each request only sends the variable suffix.
+
+        Falls back to a regular model with the prefix as system instruction
+        when the prefix cannot be cached (e.g. it is below the API's minimum
+        size or the model does not support caching).
+
+        Args:
+            model_name: Name of the Gemini model
+            system_instruction: Static instructions shared by every request
+            contents: Optional static content appended after the instructions
+        """
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.contents = [text for text in (contents or []) if text]
+
+        # Full static prefix, used to key the response cache
+        self.prefix = system_instruction + "".join(self.contents)
+
+        self._lock = threading.Lock()
+        self._cached_content = None
+        self._expires_at = 0.0
+        self._model = None
+
+    def _caching_available(self) -> bool:
+        return self.model_name not in CachedPrefixModel._uncacheable_models
+
+    def _is_current(self) -> bool:
+        return self._model is not None and (
+            not self._caching_available() or time.monotonic() < self._expires_at)
+
+    def get(self) -> genai.GenerativeModel:
+        """Return a model bound to the cached prefix, refreshing it before it expires"""
+        with self._lock:
+            if self._is_current():
+                return self._model
+
+            if self._caching_available():
+                try:
+                    # The previous cache is left to expire on its TTL, since
+                    # requests that already picked up its model may still use it
+                    self._cached_content = caching.CachedContent.create(
+                        model=self.model_name,
+                        system_instruction=self.system_instruction,
+                        contents=self.contents or None,
+                        ttl=CONTEXT_CACHE_TTL
+                    )
+                    # Refresh a little early so in-flight requests never hit an expired cache
+                    self._expires_at = time.monotonic() + CONTEXT_CACHE_TTL.total_seconds() * 0.9
+                    self._model = genai.GenerativeModel.from_cached_content(self._cached_content)
+                    return self._model
+                except Exception as e:
+                    print(f"Context caching unavailable, sending prompt prefix inline: {e}")
+                    CachedPrefixModel._uncacheable_models.add(self.model_name)
+
+            self._model = genai.GenerativeModel(
+                self.model_name,
+                system_instruction=self.prefix
+            )
+            return self._model
+
+    async def get_async(self) -> genai.GenerativeModel:
+        """Like get(), but creates or refreshes the cached prefix off the event loop"""
+        if self._is_current():
+            return self._model
+        return await asyncio.to_thread(self.get)
+
+    def close(self):
+        """Delete the server-side cached prefix"""
+        with self._lock:
+            self._delete_cached_content()
+            self._model = None
+
+    def _delete_cached_content(self):
+        if self._cached_content is not None:
+            try:
+                self._cached_content.delete()
+            except Exception as e:
+                print(f"Error deleting cached prompt prefix: {e}")
+            self._cached_content = None
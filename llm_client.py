@@ -0,0 +1,71 @@
+"""
+Shared Gemini client setup used by all agents
+"""
+import google.generativeai as genai
+import asyncio
+import functools
+import os
+import threading
+from typing import Any, Coroutine
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
+
+
+@functools.lru_cache(maxsize=1)
+def configure():
+    """Configure the Gemini SDK once per process"""
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+
+
+@functools.lru_cache(maxsize=1)
+def get_model() -> genai.GenerativeModel:
+    """Get the shared Gemini model"""
+    configure()
+    return genai.GenerativeModel(MODEL_NAME)
+
+
+@functools.lru_cache(maxsize=None)
+def get_generation_config(default_temperature: float) -> genai.types.GenerationConfig:
+    """
+    Get the shared generation config
+
+    Args:
+        default_temperature: Temperature to use when TEMPERATURE is not set
+
+    Returns:
+        Generation config shared by every caller with the same default
+    """
+    return genai.types.GenerationConfig(
+        temperature=float(os.getenv('TEMPERATURE', str(default_temperature))),
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=int(os.getenv('MAX_OUTPUT_TOKENS', '8192')),
+    )
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Get the shared background event loop, starting it on first use"""
+    global _loop
+    # Locked so worker threads calling run_async at once never start two loops
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+
+def run_async(coro: Coroutine) -> Any:
+    """
+    Run a coroutine on the shared background event loop
+
+    The SDK's async gRPC client is created once and bound to the loop it was
+    first used on, so every async request must run on the same loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
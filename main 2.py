@@ -2,8 +2,9 @@
 Main pipeline for AI-powered trend analysis
 """
 import argparse
-import json
+import orjson
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
 from tqdm import tqdm
@@ -17,8 +18,8 @@ from trend_analyzer import TrendAnalyzer
 def load_seed_topics(seed_file: str = None) -> list:
     """Load seed topics from file if provided"""
     if seed_file and os.path.exists(seed_file):
-        with open(seed_file, 'r') as f:
-            return json.load(f)
+        with open(seed_file, 'rb') as f:
+            return orjson.loads(f.read())
 
     # Default seed topics for food delivery apps
     return [
@@ -94,42 +95,30 @@ def main():
 
     print(f"Loaded {len(seed_topics)} seed topics")
 
-    # Scrape reviews for the 30-day period
+    # Scrape reviews for the 30-day period, starting topic extraction for
+    # each day in a worker thread as soon as it has been fully scraped
     print(f"\n[2/5] Scraping reviews from Google Play Store...")
     print(f"Fetching reviews from {start_date.date()} to {target_date.date()}")
-    reviews_by_date = scraper.scrape_reviews_by_date_range(
-        start_date,
-        target_date  # Fetch enough reviews to cover 30 days
-    )
-
-    # Check if we have any reviews
-    total_reviews = sum(len(revs) for revs in reviews_by_date.values())
-    if total_reviews == 0:
-        print("\n" + "=" * 80)
-        print("ERROR: No reviews found in the specified date range!")
-        print("=" * 80)
-        print("\nPlease try:")
-        print("1. Using a more recent date range (last 30 days from today)")
-        print("2. Verifying the app ID is correct")
-        print("3. Checking if the app has recent reviews")
-        return
-
-    # Process each day in the 30-day window
     print(f"\n[3/5] Processing daily batches with AI agents...")
-    print(f"Processing {total_reviews} reviews across {lookback_days + 1} days")
 
-    current_date = start_date
+    total_reviews = 0
     days_processed = 0
 
-    with tqdm(total=lookback_days + 1, desc="Processing days") as pbar:
-        while current_date <= target_date:
-            date_key = current_date.strftime('%Y-%m-%d')
-            daily_reviews = reviews_by_date.get(date_key, [])
-
-            if daily_reviews:
+    try:
+        with ThreadPoolExecutor(max_workers=extractor.concurrency) as pool, \
+                tqdm(desc="Processing days", unit="day") as pbar:
+            futures = {}
+            for date_key, daily_reviews in scraper.iter_reviews_by_date(start_date, target_date):
                 days_processed += 1
+                total_reviews += len(daily_reviews)
+
                 # Extract topics
-                extraction_results = extractor.extract_topics_from_batch(daily_reviews)
+                futures[pool.submit(extractor.extract_topics_from_batch, daily_reviews)] = date_key
+
+            # Consolidation mutates the shared taxonomy, so it runs serially
+            for future in as_completed(futures):
+                date_key = futures[future]
+                extraction_results = future.result()
 
                 # Get unique topics from this batch
                 unique_topics = extractor.get_all_unique_topics(extraction_results)
@@ -137,16 +126,30 @@ def main():
                 # Consolidate topics (agent builds/updates taxonomy)
                 topic_mapping = consolidator.consolidate_topics(unique_topics)
 
-                # Apply mapping to results
-                mapped_results = consolidator.apply_mapping(extraction_results)
+                # Apply mapping to results as (review, topic id) pairs
+                topic_pairs = consolidator.map_topic_pairs(extraction_results)
 
                 # Add to trend analyzer
-                analyzer.add_daily_data(date_key, mapped_results)
+                analyzer.add_daily_counts(date_key, topic_pairs[:, 1], consolidator.get_topic_names())
 
-            current_date += timedelta(days=1)
-            pbar.update(1)
+                pbar.update(1)
+    finally:
+        # Delete the server-side prompt caches instead of waiting for their TTL
+        extractor.close()
+        consolidator.close()
+
+    # Check if we have any reviews
+    if total_reviews == 0:
+        print("\n" + "=" * 80)
+        print("ERROR: No reviews found in the specified date range!")
+        print("=" * 80)
+        print("\nPlease try:")
+        print("1. Using a more recent date range (last 30 days from today)")
+        print("2. Verifying the app ID is correct")
+        print("3. Checking if the app has recent reviews")
+        return
 
-    print(f"Processed {days_processed} days with reviews")
+    print(f"Processed {total_reviews} reviews across {days_processed} days with reviews")
 
     # Generate trend report for the 30-day period (T-30 to T)
     print(f"\n[4/5] Generating trend report...")
@@ -165,8 +168,9 @@ def main():
 
     # Save topic mapping
     mapping_path = output_dir / f"topic_mapping_{args.target_date}.json"
-    with open(mapping_path, 'w') as f:
-        json.dump(consolidator.get_topic_mapping(), f, indent=2)
+    mapping_path.write_bytes(
+        orjson.dumps(consolidator.get_topic_mapping(), option=orjson.OPT_INDENT_2)
+    )
 
     # Save metadata and insights
     metadata = {
@@ -182,8 +186,7 @@ def main():
     }
 
     metadata_path = output_dir / f"metadata_{args.target_date}.json"
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    metadata_path.write_bytes(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
 
     # Print summary
     print("\n" + "=" * 80)
@@ -2,94 +2,186 @@
 Review scraper for Google Play Store
 """
 from google_play_scraper import Sort, reviews
+from google_play_scraper.exceptions import ExtraHTTPError
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import Dict, Iterator, List, Tuple
+from urllib.error import URLError
+import re
+import threading
 import time
 from tqdm import tqdm
 
+# Retry settings for throttled or failed page fetches
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 2.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """
+        Token-bucket rate limiter
+
+        Args:
+            rate: Tokens added per second
+            burst: Maximum number of tokens that can accumulate
+        """
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, waiting only if the bucket is empty"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            time.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 0.0
+            self.updated = time.monotonic()
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Whether a fetch error indicates throttling, a server error or a timeout"""
+    if isinstance(error, ExtraHTTPError):
+        # google_play_scraper only keeps the status code in the message
+        match = re.search(r'Status code (\d+)', str(error))
+        return match is None or int(match.group(1)) == 429 or int(match.group(1)) >= 500
+    return isinstance(error, (URLError, TimeoutError, ConnectionError))
+
 
 class ReviewScraper:
-    def __init__(self, app_id: str):
+    def __init__(self, app_id: str, requests_per_second: float = 5.0, burst: int = 10):
         """
         Initialize the scraper for a specific app
 
         Args:
             app_id: Google Play Store app ID (e.g., 'in.swiggy.android')
+            requests_per_second: Sustained rate of review page requests
+            burst: Number of requests that may be sent back-to-back
         """
         self.app_id = app_id
+        self.rate_limiter = TokenBucket(requests_per_second, burst)
 
-    def scrape_reviews_by_date_range(
+    def _fetch_page(self, continuation_token=None):
+        """
+        Fetch one page of newest reviews, backing off exponentially only when
+        the request is throttled, times out or hits a server error
+        """
+        for attempt in range(MAX_RETRIES):
+            self.rate_limiter.acquire()
+            try:
+                return reviews(
+                    self.app_id,
+                    lang='en',
+                    country='us',
+                    sort=Sort.NEWEST,
+                    count=200,
+                    continuation_token=continuation_token
+                )
+            except Exception as e:
+                if attempt == MAX_RETRIES - 1 or not _is_retryable(e):
+                    raise
+                delay = RETRY_BASE_DELAY * 2 ** attempt
+                print(f"Error fetching reviews: {e}, retrying in {delay:.0f}s")
+                time.sleep(delay)
+
+    def iter_reviews_by_date(
             self,
             start_date: datetime,
-            end_date: datetime,
-            max_reviews_per_day: int = 1000
-    ) -> Dict[str, List[Dict]]:
+            end_date: datetime
+    ) -> Iterator[Tuple[str, List[Dict]]]:
         """
-        Scrape reviews for a date range, organized by date
+        Stream reviews for a date range one completed day at a time
+
+        Reviews are fetched newest first, so a day is complete once a fetched
+        page reaches past it. Days are yielded from newest to oldest as soon as
+        they are complete; days without reviews are skipped.
 
         Args:
             start_date: Start date for scraping
             end_date: End date for scraping
-            max_reviews_per_day: Maximum reviews to fetch per day
 
-        Returns:
-            Dictionary with dates as keys and lists of reviews as values
+        Yields:
+            Tuples of (date string in YYYY-MM-DD format, list of reviews)
         """
         print(f"Scraping reviews for {self.app_id} from {start_date.date()} to {end_date.date()}")
 
-        # Fetch reviews sorted by newest
-        all_reviews = []
+        pending = {}  # Reviews of days (keyed by date) that may still receive more reviews
+        yielded = set()
         continuation_token = None
+        done = False
 
         # Fetch in batches until we have enough reviews covering our date range
-        while True:
+        while not done:
             try:
-                result, continuation_token = reviews(
-                    self.app_id,
-                    lang='en',
-                    country='us',
-                    sort=Sort.NEWEST,
-                    count=200,
-                    continuation_token=continuation_token
-                )
+                result, continuation_token = self._fetch_page(continuation_token)
+            except Exception as e:
+                print(f"Error fetching reviews: {e}")
+                break
 
-                all_reviews.extend(result)
+            for review in result:
+                review_date = review['at']
 
-                # Check if we've gone back far enough
-                if result and result[-1]['at'] < start_date:
+                # Reviews are newest first, so the first one before the range ends it
+                if review_date < start_date:
+                    done = True
                     break
 
-                if not continuation_token:
-                    break
+                if review_date <= end_date:
+                    day = review_date.date()
+                    if day not in yielded:
+                        pending.setdefault(day, []).append({
+                            'content': review['content'],
+                            'score': review['score'],
+                            'at': review_date.isoformat(),
+                            'reviewId': review['reviewId']
+                        })
+
+            if done or not result or not continuation_token:
+                break
 
-                # Rate limiting
-                time.sleep(0.5)
+            # Every day newer than the last fetched review is complete
+            boundary = result[-1]['at'].date()
+            for day in sorted(pending, reverse=True):
+                if day > boundary:
+                    yielded.add(day)
+                    yield day.strftime('%Y-%m-%d'), pending.pop(day)
 
-            except Exception as e:
-                print(f"Error fetching reviews: {e}")
-                break
+        for day in sorted(pending, reverse=True):
+            yield day.strftime('%Y-%m-%d'), pending[day]
+
+    def scrape_reviews_by_date_range(
+            self,
+            start_date: datetime,
+            end_date: datetime,
+            max_reviews_per_day: int = 1000
+    ) -> Dict[str, List[Dict]]:
+        """
+        Scrape reviews for a date range, organized by date
 
-        # Organize reviews by date
-        reviews_by_date = {}
-        current_date = start_date
-
-        while current_date <= end_date:
-            date_key = current_date.strftime('%Y-%m-%d')
-            reviews_by_date[date_key] = []
-            current_date += timedelta(days=1)
-
-        # Filter and organize reviews
-        for review in all_reviews:
-            review_date = review['at']
-            if start_date <= review_date <= end_date:
-                date_key = review_date.strftime('%Y-%m-%d')
-                if date_key in reviews_by_date:
-                    reviews_by_date[date_key].append({
-                        'content': review['content'],
-                        'score': review['score'],
-                        'at': review['at'].isoformat(),
-                        'reviewId': review['reviewId']
-                    })
+        Args:
+            start_date: Start date for scraping
+            end_date: End date for scraping
+            max_reviews_per_day: Maximum reviews to fetch per day
+
+        Returns:
+            Dictionary with dates as keys and lists of reviews as values
+        """
+        # Organize reviews by date, with an entry for every day in the range
+        reviews_by_date = {
+            (start_date + timedelta(days=i)).strftime('%Y-%m-%d'): []
+            for i in range((end_date - start_date).days + 1)
+        }
+
+        for date_key, daily_reviews in self.iter_reviews_by_date(start_date, end_date):
+            reviews_by_date[date_key] = daily_reviews
 
         # Print statistics
         total_reviews = sum(len(revs) for revs in reviews_by_date.values())
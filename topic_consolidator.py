@@ -1,34 +1,129 @@
 """
 AI Agent for consolidating similar topics to maintain high recall using Gemini
 """
-import google.generativeai as genai
-import json
+import dataclasses
+import orjson
 import os
-from typing import List, Dict, Set
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Set, Tuple, Union
 from dotenv import load_dotenv
+from google.generativeai.types import GenerationConfig
+from pydantic import BaseModel, TypeAdapter
+from sentence_transformers import SentenceTransformer
+
+from llm_cache import CachedPrefixModel, cache, get_cached, make_key
+from llm_client import MODEL_NAME, configure, get_generation_config, get_model
 
 load_dotenv()
 
+# Cosine-similarity band for embedding lookups: above ACCEPT the nearest
+# canonical topic is taken as-is, below REJECT the topic becomes a new
+# canonical topic, and only the ambiguous band in between is sent to Gemini.
+SIMILARITY_ACCEPT = float(os.getenv('SIMILARITY_ACCEPT', '0.82'))
+SIMILARITY_REJECT = float(os.getenv('SIMILARITY_REJECT', '0.60'))
+
+# Bump when the canonical naming policy changes so saved taxonomies are rebuilt
+STATE_VERSION = 1
+
+
+class TopicMapping(BaseModel):
+    """Canonical form chosen for one topic"""
+    topic: str
+    canonical: str
+
+
+# Validates the structured output of taxonomy and batched lookup requests
+TOPIC_MAPPINGS = TypeAdapter(list[TopicMapping])
+
+# Re-upload the cached canonical topic list once it has grown by this fraction
+CONTEXT_REFRESH_GROWTH = float(os.getenv('CONTEXT_REFRESH_GROWTH', '0.2'))
+
+# Static instructions shared by every canonical topic lookup
+LOOKUP_INSTRUCTIONS = """You are an expert AI agent for topic consolidation and taxonomy management.
+
+AGENTIC TASK:
+Given new topics and existing canonical topics, you must, for each new topic:
+1. Analyze the semantic meaning of the new topic
+2. Compare it against all existing canonical topics
+3. Reason about whether it matches any existing topic
+4. Make a decision: merge with existing OR create new canonical topic
+
+REASONING PROCESS:
+- Understand what issue/request the new topic represents
+- For each existing canonical topic, ask: "Do these refer to the same underlying issue?"
+- Consider variations in wording but same meaning (e.g., "rude" vs "impolite" vs "behaved badly")
+- Be conservative - only match if they CLEARLY mean the same thing
+- If no clear match, the new topic becomes a new canonical topic
+
+CRITICAL RULES:
+1. Match only if the topics clearly refer to the same issue/request
+2. Consider semantic similarity, not just word overlap
+3. When in doubt, create a new canonical topic (better to have separate topics than incorrect merging)
+4. Preserve important distinctions
+
+DECISION EXAMPLES:
+Example 1:
+New: "Delivery person was impolite"
+Existing: ["Delivery partner rude", "Food cold"]
+Reasoning: "Impolite" and "rude" describe the same behavior issue → MATCH
+Decision: "Delivery partner rude"
+
+Example 2:
+New: "App is slow"
+Existing: ["App crashes", "Payment failed"]
+Reasoning: "Slow" is different from "crashes" (performance vs stability) → NO MATCH
+Decision: "App is slow" (new canonical topic)"""
+
 
 class TopicConsolidator:
     def __init__(self):
         """
         Initialize the topic consolidator agent
         """
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        self.model = genai.GenerativeModel(
-            os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
-        )
+        configure()
+        self.model_name = MODEL_NAME
+        self.model = get_model()
         self.topic_mapping = {}  # Maps variant topics to canonical topics
         self.canonical_topics = set()  # Set of canonical topic names
 
+        # Topics mapped to themselves only because the agent failed; used for
+        # this run but not saved, so the next run asks again
+        self._fallback_topics = set()
+
+        # Local sentence embedder for nearest-neighbour canonical lookups
+        self.embedder = SentenceTransformer(
+            os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+        )
+        # Normalized embeddings, row-aligned with self._canonical_list
+        self._canonical_list = []
+        self._canonical_embs = np.zeros(
+            (0, self.embedder.get_sentence_embedding_dimension()),
+            dtype=np.float32
+        )
+
+        # Integer ids for mapped topics, so occurrences can be counted as arrays
+        self._canon_to_id = {}
+        self._topic_names = []  # Topic name for each id
+
+        # Lookup model with the instructions and a snapshot of the canonical
+        # topics cached server-side; created lazily on the first lookup
+        self._lookup_model = None
+        self._cached_canonicals = set()
+
         # Generation config for consistent output
-        self.generation_config = {
-            'temperature': float(os.getenv('TEMPERATURE', '0.3')),  # Lower temp for consistency
-            'top_p': 0.95,
-            'top_k': 40,
-            'max_output_tokens': int(os.getenv('MAX_OUTPUT_TOKENS', '8192')),
-        }
+        self.generation_config = get_generation_config(0.3)  # Lower temp for consistency
+
+        # Same settings, constrained to a list of topic mappings
+        self.mapping_generation_config = dataclasses.replace(
+            self.generation_config,
+            response_mime_type='application/json',
+            response_schema=list[TopicMapping]
+        )
+
+        # Taxonomy saved by earlier runs, so known topics need no agent calls
+        self._state_path = Path(os.getenv('CONSOLIDATOR_STATE', './.consolidator_state.json'))
+        self._load_state()
 
     def consolidate_topics(self, new_topics: Set[str]) -> Dict[str, str]:
         """
@@ -43,31 +138,174 @@ class TopicConsolidator:
         if not new_topics:
             return {}
 
+        known_topics = len(self.topic_mapping)
+        mapping = self._consolidate(new_topics)
+
+        if len(self.topic_mapping) != known_topics:
+            self._save_state()
+
+        return mapping
+
+    def _consolidate(self, new_topics: Set[str]) -> Dict[str, str]:
+        """
+        Map new topics to canonical topics, updating the taxonomy
+        """
         mapping = {}
 
         # If we have no canonical topics yet, process all at once
         if not self.canonical_topics:
-            mapping = self._create_initial_taxonomy(list(new_topics))
+            mapping = self._create_initial_taxonomy(sorted(new_topics))
+            if mapping is None:
+                # Identity mapping on error
+                mapping = {topic: topic for topic in new_topics}
+                self._fallback_topics.update(mapping)
             self._update_taxonomy(mapping)
             return mapping
 
-        # Otherwise, map new topics to existing canonical topics using agent reasoning
-        for topic in new_topics:
-            # Check if already mapped
+        # Reuse mappings for topics we have already seen
+        unknown = []
+        for topic in sorted(new_topics):
             if topic in self.topic_mapping:
                 mapping[topic] = self.topic_mapping[topic]
             else:
-                # Find canonical topic for this new topic
-                canonical = self._find_canonical_topic(topic)
-                mapping[topic] = canonical
-                self.topic_mapping[topic] = canonical
-                self.canonical_topics.add(canonical)
+                unknown.append(topic)
+
+        if not unknown:
+            return mapping
+
+        # Embed all unknown topics in one batch, then match each against the
+        # canonical topics by cosine similarity (embeddings are normalized)
+        new_embs = self._encode(unknown)
+        ambiguous = []
+
+        for topic, emb in zip(unknown, new_embs):
+            sims = self._canonical_embs @ emb
+            best = int(np.argmax(sims))
+            max_sim = sims[best]
+
+            if max_sim > SIMILARITY_ACCEPT:
+                canonical = self._canonical_list[best]
+            elif max_sim < SIMILARITY_REJECT:
+                canonical = topic
+            else:
+                # Ambiguous match - defer to the agent
+                ambiguous.append((topic, emb))
+                continue
+
+            mapping[topic] = canonical
+            self.topic_mapping[topic] = canonical
+            self._add_canonical(canonical, emb if canonical == topic else None)
+
+        if not ambiguous:
+            return mapping
+
+        # Resolve all ambiguous topics with a single agent call
+        ambiguous_topics = [topic for topic, _ in ambiguous]
+        if len(ambiguous_topics) == 1:
+            resolved = {ambiguous_topics[0]: self._find_canonical_topic(ambiguous_topics[0])}
+        else:
+            resolved = self._find_canonical_topics(ambiguous_topics)
+
+        for topic, emb in ambiguous:
+            canonical = resolved.get(topic)
+            if canonical is None:
+                # Unresolved by the agent - keep the topic as-is for now
+                canonical = topic
+                self._fallback_topics.add(topic)
+            mapping[topic] = canonical
+            self.topic_mapping[topic] = canonical
+            self._add_canonical(canonical, emb if canonical == topic else None)
 
         return mapping
 
-    def _create_initial_taxonomy(self, topics: List[str]) -> Dict[str, str]:
+    def _load_state(self):
+        """
+        Load the taxonomy saved by a previous run, if compatible
+        """
+        if not self._state_path.exists():
+            return
+
+        try:
+            state = orjson.loads(self._state_path.read_bytes())
+            if not isinstance(state, dict):
+                raise ValueError("state is not an object")
+
+            if state.get('version') != STATE_VERSION:
+                print(f"Ignoring consolidator state from version {state.get('version')}, rebuilding taxonomy")
+                return
+
+            mapping = state['mapping']
+            canonical_list = state['canonical']
+            if not isinstance(mapping, dict) or not all(
+                    isinstance(canonical, str) for canonical in mapping.values()):
+                raise ValueError("'mapping' is not an object of topic names")
+            if not isinstance(canonical_list, list) or not all(
+                    isinstance(canonical, str) for canonical in canonical_list):
+                raise ValueError("'canonical' is not a list of topic names")
+        except Exception as e:
+            print(f"Error loading consolidator state: {e}")
+            return
+
+        self.topic_mapping = mapping
+        self._canonical_list = canonical_list
+        self.canonical_topics = set(self._canonical_list)
+        if self._canonical_list:
+            self._canonical_embs = self._encode(self._canonical_list)
+
+    def _save_state(self):
+        """
+        Atomically write the current taxonomy to disk, leaving out fallback
+        mappings and canonical topics only they introduced
+        """
+        mapping = {
+            topic: canonical for topic, canonical in self.topic_mapping.items()
+            if topic not in self._fallback_topics
+        }
+        used_canonicals = set(mapping.values())
+
+        state = {
+            'version': STATE_VERSION,
+            'mapping': mapping,
+            'canonical': [canonical for canonical in self._canonical_list if canonical in used_canonicals]
+        }
+
+        try:
+            tmp_path = self._state_path.with_suffix('.tmp')
+            tmp_path.write_bytes(orjson.dumps(state))
+            tmp_path.replace(self._state_path)
+        except Exception as e:
+            print(f"Error saving consolidator state: {e}")
+
+    def _encode(self, topics: List[str]) -> np.ndarray:
+        """
+        Encode topics into normalized float32 embeddings
+        """
+        return self.embedder.encode(
+            list(topics),
+            batch_size=64,
+            normalize_embeddings=True
+        ).astype(np.float32, copy=False)
+
+    def _add_canonical(self, canonical: str, embedding: np.ndarray = None):
+        """
+        Register a canonical topic and append its embedding to the lookup matrix
+        """
+        if canonical in self.canonical_topics:
+            return
+
+        if embedding is None:
+            embedding = self._encode([canonical])[0]
+
+        self.canonical_topics.add(canonical)
+        self._canonical_list.append(canonical)
+        self._canonical_embs = np.vstack([self._canonical_embs, embedding])
+
+    def _create_initial_taxonomy(self, topics: List[str]) -> Union[Dict[str, str], None]:
         """
         Create initial taxonomy from first batch of topics with agentic reasoning
+
+        Returns:
+            Mapping of topics to canonical topics, or None if the agent call failed
         """
         if not topics:
             return {}
@@ -102,144 +340,262 @@ Decision: Create 2 canonical topics
 Topics to consolidate:
 {chr(10).join(f"- {topic}" for topic in topics)}
 
-Respond with ONLY a JSON object mapping each original topic to its canonical form:
-{{
-  "original topic 1": "canonical topic 1",
-  "original topic 2": "canonical topic 1",
-  "original topic 3": "canonical topic 2",
+Respond with ONLY a JSON array mapping each original topic to its canonical form:
+[
+  {{"topic": "original topic 1", "canonical": "canonical topic 1"}},
+  {{"topic": "original topic 2", "canonical": "canonical topic 1"}},
+  {{"topic": "original topic 3", "canonical": "canonical topic 2"}},
   ...
-}}"""
+]"""
 
         try:
-            response = self.model.generate_content(
-                prompt,
-                generation_config=self.generation_config
-            )
-
-            response_text = response.text.strip()
+            cache_key = make_key(self.model_name, self.mapping_generation_config, prompt)
+            items = get_cached(cache_key, TOPIC_MAPPINGS)
 
-            # Clean JSON formatting
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
+            if items is None:
+                response = self.model.generate_content(
+                    prompt,
+                    generation_config=self.mapping_generation_config
+                )
+                response_text = response.text.strip()
+                items = TOPIC_MAPPINGS.validate_json(response_text)
+                cache.set(cache_key, response_text)
 
-            mapping = json.loads(response_text)
-            return mapping
+            return {item.topic: item.canonical for item in items}
 
         except Exception as e:
             print(f"Error in initial taxonomy creation: {e}")
-            # Return identity mapping on error
-            return {topic: topic for topic in topics}
+            return None
 
-    def _find_canonical_topic(self, new_topic: str) -> str:
+    def _get_lookup_model(self) -> CachedPrefixModel:
         """
-        Find the canonical topic for a new topic using agentic reasoning
+        Return the lookup model, re-caching the canonical topic list once it
+        has grown noticeably since the last snapshot
         """
-        if not self.canonical_topics:
-            return new_topic
-
-        canonical_list = list(self.canonical_topics)
+        grown = len(self.canonical_topics - self._cached_canonicals)
+        if self._lookup_model is None or grown > CONTEXT_REFRESH_GROWTH * len(self._cached_canonicals):
+            if self._lookup_model is not None:
+                self._lookup_model.close()
+
+            self._cached_canonicals = set(self.canonical_topics)
+            canonical_text = "\n\nExisting canonical topics:\n" + "\n".join(
+                f"- {topic}" for topic in sorted(self._cached_canonicals)
+            )
+            self._lookup_model = CachedPrefixModel(
+                self.model_name,
+                LOOKUP_INSTRUCTIONS,
+                [canonical_text]
+            )
 
-        prompt = f"""You are an expert AI agent for topic consolidation and taxonomy management.
+        return self._lookup_model
 
-AGENTIC TASK:
-Given a new topic and existing canonical topics, you must:
-1. Analyze the semantic meaning of the new topic
-2. Compare it against all existing canonical topics
-3. Reason about whether it matches any existing topic
-4. Make a decision: merge with existing OR create new canonical topic
+    def _lookup(self, prompt: str, generation_config: GenerationConfig, adapter: TypeAdapter = None) -> tuple:
+        """
+        Send a lookup prompt after the cached prefix, listing any canonical
+        topics added since the snapshot was taken
 
-REASONING PROCESS:
-- Understand what issue/request the new topic represents
-- For each existing canonical topic, ask: "Do these refer to the same underlying issue?"
-- Consider variations in wording but same meaning (e.g., "rude" vs "impolite" vs "behaved badly")
-- Be conservative - only match if they CLEARLY mean the same thing
-- If no clear match, the new topic becomes a new canonical topic
+        Args:
+            prompt: Lookup prompt
+            generation_config: Generation settings for the request
+            adapter: Optional validator; when given, the response is returned parsed
 
-CRITICAL RULES:
-1. Match only if the topics clearly refer to the same issue/request
-2. Consider semantic similarity, not just word overlap
-3. When in doubt, create a new canonical topic (better to have separate topics than incorrect merging)
-4. Preserve important distinctions
+        Returns:
+            Tuple of (response, cache key, fresh response text). The fresh text
+            is None when the response came from the cache; otherwise callers
+            store it under the cache key once they accept the answer
+        """
+        lookup_model = self._get_lookup_model()
+
+        # Sorted so the prompt (and its cache key) is stable across runs
+        added = sorted(self.canonical_topics - self._cached_canonicals)
+        if added:
+            prompt = "Additional existing canonical topics:\n" + "\n".join(
+                f"- {topic}" for topic in added
+            ) + "\n\n" + prompt
+
+        cache_key = make_key(self.model_name, generation_config, lookup_model.prefix + prompt)
+        cached = cache.get(cache_key) if adapter is None else get_cached(cache_key, adapter)
+        if cached is not None:
+            return cached, cache_key, None
+
+        response = lookup_model.get().generate_content(
+            prompt,
+            generation_config=generation_config
+        )
+        response_text = response.text.strip()
+        result = response_text if adapter is None else adapter.validate_json(response_text)
 
-DECISION EXAMPLES:
-Example 1:
-New: "Delivery person was impolite"
-Existing: ["Delivery partner rude", "Food cold"]
-Reasoning: "Impolite" and "rude" describe the same behavior issue → MATCH
-Decision: "Delivery partner rude"
+        return result, cache_key, response_text
 
-Example 2:
-New: "App is slow"
-Existing: ["App crashes", "Payment failed"]
-Reasoning: "Slow" is different from "crashes" (performance vs stability) → NO MATCH
-Decision: "App is slow" (new canonical topic)
+    def _find_canonical_topic(self, new_topic: str) -> Union[str, None]:
+        """
+        Find the canonical topic for a new topic using agentic reasoning
 
-New topic: "{new_topic}"
+        Returns:
+            Canonical topic, or None if the agent failed or gave an unexpected answer
+        """
+        if not self.canonical_topics:
+            return new_topic
 
-Existing canonical topics:
-{chr(10).join(f"- {topic}" for topic in canonical_list)}
+        prompt = f"""New topic: "{new_topic}"
 
 Respond with ONLY the canonical topic name (either an existing one or the new topic as-is). Do not include any explanation, just the topic name:"""
 
         try:
-            response = self.model.generate_content(
-                prompt,
-                generation_config=self.generation_config
-            )
-
-            canonical = response.text.strip().strip('"\'')
+            response_text, cache_key, fresh_text = self._lookup(prompt, self.generation_config)
+            canonical = response_text.strip('"\'')
 
             # Validate the response is one of the canonical topics or the new topic
             if canonical in self.canonical_topics or canonical == new_topic:
+                if fresh_text is not None:
+                    cache.set(cache_key, fresh_text)
                 return canonical
             else:
-                # If AI returned something unexpected, default to new topic
+                # If AI returned something unexpected, the caller keeps the new topic
                 print(f"Warning: Unexpected canonical topic '{canonical}', using new topic '{new_topic}'")
-                return new_topic
+                return None
 
         except Exception as e:
             print(f"Error finding canonical topic: {e}")
-            return new_topic
+            return None
+
+    def _find_canonical_topics(self, new_topics: List[str]) -> Dict[str, str]:
+        """
+        Find canonical topics for several new topics with a single agent call
+
+        Returns:
+            Mapping of the topics the agent resolved; failed, missing and
+            unexpected answers are left out
+        """
+        if not self.canonical_topics:
+            return {topic: topic for topic in new_topics}
+
+        prompt = f"""New topics:
+{chr(10).join(f"{idx}. {topic}" for idx, topic in enumerate(new_topics, 1))}
+
+Respond with ONLY a JSON array mapping each new topic (exactly as written) to its canonical topic (either an existing one or the new topic as-is):
+[
+  {{"topic": "new topic 1", "canonical": "canonical topic"}},
+  {{"topic": "new topic 2", "canonical": "new topic 2"}},
+  ...
+]"""
+
+        try:
+            items, cache_key, fresh_text = self._lookup(prompt, self.mapping_generation_config, TOPIC_MAPPINGS)
+
+            results = {item.topic: item.canonical for item in items}
+            if fresh_text is not None:
+                cache.set(cache_key, fresh_text)
+
+        except Exception as e:
+            print(f"Error finding canonical topics: {e}")
+            return {}
+
+        # Validate each answer is one of the canonical topics or the new topic
+        mapping = {}
+        for topic in new_topics:
+            if topic not in results:
+                continue
+            canonical = results[topic].strip().strip('"\'')
+            if canonical in self.canonical_topics or canonical == topic:
+                mapping[topic] = canonical
+            else:
+                print(f"Warning: Unexpected canonical topic '{canonical}', using new topic '{topic}'")
+
+        return mapping
 
     def _update_taxonomy(self, mapping: Dict[str, str]):
         """
         Update internal taxonomy with new mappings
         """
+        new_canonicals = []
         for original, canonical in mapping.items():
             self.topic_mapping[original] = canonical
-            self.canonical_topics.add(canonical)
+            if canonical not in self.canonical_topics and canonical not in new_canonicals:
+                new_canonicals.append(canonical)
+
+        if new_canonicals:
+            self.canonical_topics.update(new_canonicals)
+            self._canonical_list.extend(new_canonicals)
+            self._canonical_embs = np.vstack(
+                [self._canonical_embs, self._encode(new_canonicals)]
+            )
 
-    def apply_mapping(self, extraction_results: List[Dict]) -> List[Dict]:
+    def apply_mapping(
+            self,
+            extraction_results: List[Dict],
+            return_pairs: bool = False
+    ) -> Union[List[Dict], Tuple[List[Dict], np.ndarray]]:
         """
         Apply topic mapping to extraction results
 
         Args:
             extraction_results: Results from TopicExtractor
+            return_pairs: Also return the topic occurrences as an int32 array
 
         Returns:
-            Results with topics mapped to canonical forms
+            Results with topics mapped to canonical forms. With return_pairs,
+            a tuple of those results and an (N, 2) array of
+            (review index, topic id) rows; see get_topic_names for the ids
         """
-        mapped_results = []
+        get_canonical = self.topic_mapping.get
 
-        for result in extraction_results:
-            mapped_topics = [
-                self.topic_mapping.get(topic, topic)
-                for topic in result['topics']
-            ]
-
-            mapped_results.append({
+        mapped_results = [
+            {
                 'review_id': result['review_id'],
-                'topics': mapped_topics,
+                'topics': [get_canonical(topic, topic) for topic in result['topics']],
                 'content': result.get('content', ''),
                 'reasoning': result.get('reasoning', '')
-            })
+            }
+            for result in extraction_results
+        ]
+
+        if not return_pairs:
+            return mapped_results
+
+        return mapped_results, self.map_topic_pairs(extraction_results)
+
+    def map_topic_pairs(self, extraction_results: List[Dict]) -> np.ndarray:
+        """
+        Apply topic mapping to extraction results, returning only topic ids
+
+        Args:
+            extraction_results: Results from TopicExtractor
 
-        return mapped_results
+        Returns:
+            (N, 2) int32 array of (review index, topic id) rows; see
+            get_topic_names for the ids
+        """
+        get_canonical = self.topic_mapping.get
+        topic_id = self._topic_id
+
+        return np.array(
+            [
+                (review_idx, topic_id(get_canonical(topic, topic)))
+                for review_idx, result in enumerate(extraction_results)
+                for topic in result['topics']
+            ],
+            dtype=np.int32
+        ).reshape(-1, 2)
+
+    def _topic_id(self, topic: str) -> int:
+        """
+        Get the integer id of a mapped topic, assigning the next id if new
+        """
+        topic_id = self._canon_to_id.get(topic)
+        if topic_id is None:
+            topic_id = self._canon_to_id[topic] = len(self._topic_names)
+            self._topic_names.append(topic)
+        return topic_id
+
+    def close(self):
+        """Delete the server-side cached lookup prefix"""
+        if self._lookup_model is not None:
+            self._lookup_model.close()
+
+    def get_topic_names(self) -> List[str]:
+        """Get topic names indexed by the ids used in apply_mapping pairs"""
+        return list(self._topic_names)
 
     def get_topic_mapping(self) -> Dict[str, str]:
         """Get the current topic mapping dictionary"""
@@ -1,74 +1,42 @@
 """
 AI Agent for extracting topics from reviews using Gemini
 """
-import google.generativeai as genai
-import json
+import asyncio
+import dataclasses
+import hashlib
 import os
 from typing import List, Dict, Set
 from dotenv import load_dotenv
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted
+from pydantic import BaseModel, Field, TypeAdapter
 
-load_dotenv()
-
+from llm_cache import CachedPrefixModel, cache, get_cached, make_key
+from llm_client import MODEL_NAME, configure, get_generation_config, run_async
 
-class TopicExtractor:
-    def __init__(self, seed_topics: List[str] = None):
-        """
-        Initialize the topic extractor agent
-
-        Args:
-            seed_topics: Optional list of seed topics to guide extraction
-        """
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        self.model = genai.GenerativeModel(
-            os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
-        )
-        self.seed_topics = seed_topics or []
-
-        # Generation config for consistent output
-        self.generation_config = {
-            'temperature': float(os.getenv('TEMPERATURE', '0.7')),
-            'top_p': 0.95,
-            'top_k': 40,
-            'max_output_tokens': int(os.getenv('MAX_OUTPUT_TOKENS', '8192')),
-        }
-
-    def extract_topics_from_batch(self, reviews: List[Dict]) -> List[Dict]:
-        """
-        Extract topics from a batch of reviews using AI agent
-
-        Args:
-            reviews: List of review dictionaries with 'content' field
-
-        Returns:
-            List of dictionaries with review_id and extracted topics
-        """
-        if not reviews:
-            return []
+load_dotenv()
 
-        # Process in smaller chunks to avoid token limits
-        chunk_size = 30
-        all_results = []
+# Retry settings for rate-limited or timed-out Gemini requests
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
 
-        for i in range(0, len(reviews), chunk_size):
-            chunk = reviews[i:i + chunk_size]
-            results = self._process_chunk(chunk)
-            all_results.extend(results)
+# Longer reviews are truncated so one rant cannot crowd out the rest of a chunk
+MAX_REVIEW_CHARS = int(os.getenv('MAX_REVIEW_CHARS', '800'))
 
-        return all_results
 
-    def _process_chunk(self, reviews: List[Dict]) -> List[Dict]:
-        """Process a chunk of reviews with agentic reasoning"""
+class ChunkItem(BaseModel):
+    """Topics extracted for one review of a chunk"""
+    review_index: int
+    topics: List[str]
+    # Optional so one missing explanation does not fail the whole chunk; the
+    # default is kept out of the JSON schema, which Gemini's Schema rejects
+    reasoning: str = Field("", json_schema_extra=lambda schema: schema.pop('default'))
 
-        # Prepare the prompt with agentic instructions
-        reviews_text = ""
-        for idx, review in enumerate(reviews):
-            reviews_text += f"Review {idx + 1}: {review['content']}\n\n"
 
-        seed_topics_text = ""
-        if self.seed_topics:
-            seed_topics_text = f"\n\nSeed topics for reference (you can use these or create new ones based on your analysis):\n" + "\n".join(f"- {topic}" for topic in self.seed_topics)
+# Validates the structured output of an extraction request
+CHUNK_RESULTS = TypeAdapter(list[ChunkItem])
 
-        prompt = f"""You are an expert AI agent specialized in analyzing app reviews. Your task is to act as an intelligent agent that:
+# Static instructions shared by every extraction request
+EXTRACTION_INSTRUCTIONS = """You are an expert AI agent specialized in analyzing app reviews. Your task is to act as an intelligent agent that:
 1. Carefully reads and understands each review
 2. Identifies actionable topics (issues, requests, feedback)
 3. Reasons about topic categorization
@@ -86,7 +54,7 @@ GUIDELINES:
 3. Use consistent naming conventions (always use the same term for similar concepts)
 4. One review can have multiple topics
 5. If a review has no clear actionable topic, return an empty list for that review
-6. Focus on topics that are actionable for product/engineering teams{seed_topics_text}
+6. Focus on topics that are actionable for product/engineering teams
 
 REASONING EXAMPLE:
 Review: "The delivery guy was extremely rude and the food arrived cold"
@@ -95,45 +63,168 @@ Agent reasoning: This review mentions two distinct issues:
 - Issue 2: Food temperature → Topic: "Food cold"
 Decision: Extract both topics
 
-Reviews to analyze:
-{reviews_text}
-
 Respond with ONLY a JSON array where each element corresponds to a review (in order) and contains the topics found:
 [
-  {{"review_index": 1, "topics": ["topic1", "topic2"], "reasoning": "brief reason"}},
-  {{"review_index": 2, "topics": ["topic3"], "reasoning": "brief reason"}},
+  {"review_index": 1, "topics": ["topic1", "topic2"], "reasoning": "brief reason"},
+  {"review_index": 2, "topics": ["topic3"], "reasoning": "brief reason"},
   ...
 ]"""
 
-        try:
-            response = self.model.generate_content(
-                prompt,
-                generation_config=self.generation_config
-            )
+# Per-chunk request sent after the cached instructions and seed topics
+PROMPT_TEMPLATE = """Reviews to analyze:
+{reviews}"""
 
-            response_text = response.text.strip()
 
-            # Parse JSON response
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
+class TopicExtractor:
+    def __init__(self, seed_topics: List[str] = None):
+        """
+        Initialize the topic extractor agent
 
-            results = json.loads(response_text)
+        Args:
+            seed_topics: Optional list of seed topics to guide extraction
+        """
+        configure()
+        self.model_name = MODEL_NAME
+        self.seed_topics = seed_topics or []
+
+        # Built once; every chunk shares the same seed topic block
+        self._seed_topics_text = ""
+        if self.seed_topics:
+            self._seed_topics_text = f"\n\nSeed topics for reference (you can use these or create new ones based on your analysis):\n" + "\n".join(f"- {topic}" for topic in self.seed_topics)
+
+        # Instructions and seed topics are cached server-side once per run
+        self.model = CachedPrefixModel(
+            self.model_name,
+            EXTRACTION_INSTRUCTIONS,
+            [self._seed_topics_text]
+        )
+
+        # Generation config for consistent output, constrained to the chunk schema
+        self.generation_config = dataclasses.replace(
+            get_generation_config(0.7),
+            response_mime_type='application/json',
+            response_schema=list[ChunkItem]
+        )
+
+        # Maximum number of chunk requests in flight at once, across all
+        # batches; the semaphore is created on the shared event loop
+        self.concurrency = int(os.getenv('GEMINI_CONCURRENCY', '12'))
+        self._semaphore = None
+
+    def extract_topics_from_batch(self, reviews: List[Dict]) -> List[Dict]:
+        """
+        Extract topics from a batch of reviews using AI agent
+
+        Args:
+            reviews: List of review dictionaries with 'content' field
+
+        Returns:
+            List of dictionaries with review_id and extracted topics
+        """
+        if not reviews:
+            return []
+
+        # Duplicate reviews (spam, templated complaints) are only sent once
+        keys = [self._content_key(review['content']) for review in reviews]
+        first_by_key = {}
+        for key, review in zip(keys, reviews):
+            first_by_key.setdefault(key, review)
+        unique_reviews = list(first_by_key.values())
+
+        # Process in smaller chunks to avoid token limits
+        chunk_size = 30
+        chunks = [unique_reviews[i:i + chunk_size] for i in range(0, len(unique_reviews), chunk_size)]
+
+        # Send all chunks concurrently; results keep the original chunk order
+        chunk_results = run_async(self._gather_chunks(chunks))
+
+        # Fan each unique result back out to every review sharing its content
+        by_key = {
+            self._content_key(result['content']): result
+            for results in chunk_results for result in results
+        }
+
+        output = []
+        for i, (key, review) in enumerate(zip(keys, reviews)):
+            result = by_key.get(key)
+            if result:
+                output.append({
+                    'review_id': review.get('reviewId', f"review_{i}"),
+                    'topics': list(result['topics']),
+                    'content': review['content'],
+                    'reasoning': result['reasoning']
+                })
+
+        return output
+
+    @staticmethod
+    def _content_key(content: str) -> str:
+        """Hash normalized review content to detect duplicate reviews"""
+        return hashlib.blake2b((content or '').strip().lower().encode(), digest_size=16).hexdigest()
+
+    async def _gather_chunks(self, chunks: List[List[Dict]]) -> List[List[Dict]]:
+        """Process chunks concurrently, bounded by the configured concurrency"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        semaphore = self._semaphore
+        results = [None] * len(chunks)
+
+        async def run(chunk_id: int, chunk: List[Dict]):
+            async with semaphore:
+                results[chunk_id] = await self._process_chunk_async(chunk)
+
+        await asyncio.gather(*(run(i, chunk) for i, chunk in enumerate(chunks)))
+        return results
+
+    async def _generate_async(self, prompt: str):
+        """Call Gemini, backing off exponentially on rate limits and timeouts"""
+        for attempt in range(MAX_RETRIES):
+            try:
+                model = await self.model.get_async()
+                return await model.generate_content_async(
+                    prompt,
+                    generation_config=self.generation_config
+                )
+            except (ResourceExhausted, DeadlineExceeded):
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+    async def _process_chunk_async(self, reviews: List[Dict]) -> List[Dict]:
+        """Process a chunk of reviews with agentic reasoning"""
+
+        # Prepare the prompt with agentic instructions
+        reviews_text = "".join(
+            f"Review {idx + 1}: {(review['content'] or '')[:MAX_REVIEW_CHARS]}\n\n"
+            for idx, review in enumerate(reviews)
+        )
+
+        prompt = PROMPT_TEMPLATE.format(reviews=reviews_text)
+
+        try:
+            # Identical chunks from earlier runs are served from the cache
+            cache_key = make_key(self.model_name, self.generation_config, self.model.prefix + prompt)
+            results = get_cached(cache_key, CHUNK_RESULTS)
+
+            if results is None:
+                response = await self._generate_async(prompt)
+                response_text = response.text.strip()
+
+                # Parse and validate the structured JSON response
+                results = CHUNK_RESULTS.validate_json(response_text)
+                cache.set(cache_key, response_text)
 
             # Match results back to review IDs
+            by_idx = {r.review_index: r for r in results}
             output = []
             for i, review in enumerate(reviews):
-                matching_result = next((r for r in results if r['review_index'] == i + 1), None)
+                matching_result = by_idx.get(i + 1)
                 if matching_result:
                     output.append({
                         'review_id': review.get('reviewId', f"review_{i}"),
-                        'topics': matching_result['topics'],
+                        'topics': matching_result.topics,
                         'content': review['content'],
-                        'reasoning': matching_result.get('reasoning', '')
+                        'reasoning': matching_result.reasoning
                     })
 
             return output
@@ -144,6 +235,10 @@ Respond with ONLY a JSON array where each element corresponds to a review (in or
             return [{'review_id': review.get('reviewId', f"review_{i}"), 'topics': [], 'content': review['content'], 'reasoning': 'error'}
                     for i, review in enumerate(reviews)]
 
+    def close(self):
+        """Delete the server-side cached prompt prefix"""
+        self.model.close()
+
     def get_all_unique_topics(self, extraction_results: List[Dict]) -> Set[str]:
         """
         Get all unique topics from extraction results
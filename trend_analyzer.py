@@ -1,10 +1,59 @@
 """
 Trend analyzer for generating topic frequency reports
 """
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from typing import Dict, List
-from collections import defaultdict
+from collections import Counter
+from datetime import date as Date, datetime
+from typing import Dict, List, Union
+
+try:
+    from numba import njit, prange
+except ImportError:  # Optional; get_emerging_topics falls back to NumPy
+    njit = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # Optional; export_to_csv falls back to pandas
+    pa = None
+
+# Cell dtype of the counts matrix, capping one topic at 2**31 - 1 mentions per
+# day; window totals are always accumulated as int64
+COUNT_DTYPE = np.int32
+
+
+def _date_strs(start: int, end: int) -> np.ndarray:
+    """
+    Get the YYYY-MM-DD strings of every day ordinal from start to end (inclusive)
+    """
+    return pd.date_range(Date.fromordinal(start), periods=max(end - start + 1, 0), freq='D').strftime('%Y-%m-%d').to_numpy()
+
+
+if njit is not None:
+    # Compiled eagerly for the exact array types passed by get_emerging_topics, so
+    # the first report does not pay for JIT compilation
+    @njit(
+        'void(int64[:, ::1], int64, int64, int64, int64, int64[::1], int64[::1], float64[::1], boolean[::1])',
+        parallel=True,
+        cache=True
+    )
+    def _emerging_kernel(cum, r0, r1, o0, o1, recent, older, growth, selected):
+        """
+        Compute both window sums, the growth rate and the emerging decision of every topic in one pass
+        """
+        for i in prange(cum.shape[0]):
+            recent_freq = cum[i, r1] - cum[i, r0]
+            older_freq = cum[i, o1] - cum[i, o0]
+            recent[i] = recent_freq
+            older[i] = older_freq
+
+            if older_freq > 0:
+                growth[i] = (recent_freq - older_freq) / older_freq
+                selected[i] = growth[i] > 0.5
+            else:
+                growth[i] = np.inf
+                selected[i] = recent_freq >= 3
 
 
 class TrendAnalyzer:
@@ -12,7 +61,23 @@ class TrendAnalyzer:
         """
         Initialize the trend analyzer
         """
-        self.topic_frequencies = defaultdict(lambda: defaultdict(int))
+        # Topic frequencies as a counts[topic_idx, day_idx] matrix, where
+        # column 0 is the day ordinal self.first_day and every following column is the next day
+        self.topics = []  # Topic name for each row
+        self.topic_to_idx = {}
+        self.first_day = None
+        self.counts = np.zeros((0, 0), dtype=COUNT_DTYPE)
+
+        # Bumped on every data change to invalidate derived state
+        self._version = 0
+
+        # Prefix sums of counts along the days, rebuilt lazily after new data
+        self._cum = None
+        self._cum_version = -1
+
+        # Computed reports keyed by query arguments, valid for self._results_version
+        self._results = {}
+        self._results_version = 0
 
     def add_daily_data(self, date: str, extraction_results: List[Dict]):
         """
@@ -23,15 +88,136 @@ class TrendAnalyzer:
             extraction_results: List of extraction results with canonical topics
         """
         # Count topic frequencies for this date
-        topic_counts = defaultdict(int)
+        topic_counts = Counter(topic for result in extraction_results for topic in result['topics'])
+
+        # Replace this date's counts for every topic seen in the batch
+        topic_idx = np.array(self._topic_rows(list(topic_counts)), dtype=np.intp)
+        date_idx = self._date_column(date)
+        self.counts[topic_idx, date_idx] = list(topic_counts.values())
+        self._version += 1
+
+    def add_bulk(self, data: Dict[str, List[Dict]]):
+        """
+        Add extraction results for several dates at once
+
+        Args:
+            data: Extraction results with canonical topics, keyed by date string in YYYY-MM-DD format
+        """
+        if not data:
+            return
+
+        # Flatten every (topic, day) occurrence into parallel lists
+        topics = []
+        days = []
+        for date, extraction_results in data.items():
+            day_topics = [topic for result in extraction_results for topic in result['topics']]
+            topics.extend(day_topics)
+            days.extend([Date.fromisoformat(date).toordinal()] * len(day_topics))
+
+        # Grow the matrix once for new topics and once per side for new days
+        topic_idx = np.array(self._topic_rows(topics), dtype=np.intp)
+        self._date_column(min(data))
+        self._date_column(max(data))
+        date_idx = np.array(days, dtype=np.intp) - self.first_day
+
+        # Replace the counts of every (topic, date) seen, as add_daily_data does
+        self.counts[topic_idx, date_idx] = 0
+        np.add.at(self.counts, (topic_idx, date_idx), 1)
+        self._version += 1
+
+    def add_daily_counts(self, date: str, topic_ids: np.ndarray, topic_names: List[str]):
+        """
+        Add dictionary-encoded topic occurrences for a specific date
+
+        Args:
+            date: Date string in YYYY-MM-DD format
+            topic_ids: Integer array with one topic id per topic occurrence
+            topic_names: Topic names indexed by topic id
+        """
+        counts = np.bincount(topic_ids, minlength=len(topic_names))
+        present = np.flatnonzero(counts)
+
+        topic_idx = np.array(self._topic_rows([topic_names[i] for i in present]), dtype=np.intp)
+        date_idx = self._date_column(date)
+        self.counts[topic_idx, date_idx] = counts[present]
+        self._version += 1
+
+    def _topic_rows(self, topics: List[str]) -> List[int]:
+        """
+        Get the matrix row of each topic, adding rows for new topics
+        """
+        topic_to_idx = self.topic_to_idx
+        rows = []
+        for topic in topics:
+            row = topic_to_idx.get(topic)
+            if row is None:
+                row = topic_to_idx[topic] = len(self.topics)
+                self.topics.append(topic)
+            rows.append(row)
+
+        # Grow the matrix once for all new topics
+        missing = len(self.topics) - self.counts.shape[0]
+        if missing:
+            self.counts = np.pad(self.counts, ((0, missing), (0, 0)))
+
+        return rows
+
+    def _date_column(self, date: str) -> int:
+        """
+        Get the matrix column of a YYYY-MM-DD date, extending the day range if needed
+        """
+        day = Date.fromisoformat(date).toordinal()
+        if self.first_day is None:
+            self.first_day = day
 
-        for result in extraction_results:
-            for topic in result['topics']:
-                topic_counts[topic] += 1
+        col = day - self.first_day
+        if col < 0:
+            self.counts = np.pad(self.counts, ((0, 0), (-col, 0)))
+            self.first_day = day
+            col = 0
+        elif col >= self.counts.shape[1]:
+            self.counts = np.pad(self.counts, ((0, 0), (0, col - self.counts.shape[1] + 1)))
 
-        # Store in the main data structure
-        for topic, count in topic_counts.items():
-            self.topic_frequencies[topic][date] = count
+        return col
+
+    def _columns(self, start: int, end: int) -> slice:
+        """
+        Get the slice of matrix columns holding the day ordinals from start to end (inclusive)
+        """
+        if self.first_day is None:
+            return slice(0, 0)
+
+        first = min(max(start - self.first_day, 0), self.counts.shape[1])
+        last = min(end - self.first_day + 1, self.counts.shape[1])
+        return slice(first, max(first, last))
+
+    def _window_sums(self, start: int, end: int) -> np.ndarray:
+        """
+        Get every topic's total count over the day ordinals from start to end (inclusive)
+        """
+        cum = self._prefix_sums()
+        cols = self._columns(start, end)
+        return cum[:, cols.stop] - cum[:, cols.start]
+
+    def _prefix_sums(self) -> np.ndarray:
+        """
+        Get the prefix sums of counts, where cum[:, d] is the sum of the first d columns
+        """
+        if self._cum_version != self._version:
+            self._cum = np.zeros((self.counts.shape[0], self.counts.shape[1] + 1), dtype=np.int64)
+            np.cumsum(self.counts, axis=1, out=self._cum[:, 1:])
+            self._cum_version = self._version
+
+        return self._cum
+
+    def _cached_result(self, key: tuple):
+        """
+        Get a previously computed result for key, or None if the data changed since
+        """
+        if self._results_version != self._version:
+            self._results.clear()
+            self._results_version = self._version
+        return self._results.get(key)
 
     def generate_trend_report(
             self,
@@ -48,45 +234,41 @@ class TrendAnalyzer:
         Returns:
             DataFrame with topics as rows and dates as columns
         """
-        # Generate date range
-        start_date = target_date - timedelta(days=lookback_days)
-        date_range = []
-        current = start_date
-
-        while current <= target_date:
-            date_range.append(current.strftime('%Y-%m-%d'))
-            current += timedelta(days=1)
-
-        # Get all topics
-        all_topics = sorted(self.topic_frequencies.keys())
-
-        # Build the report data
-        report_data = {}
+        end_day = target_date.toordinal()
+        key = ('report', end_day, lookback_days)
+        cached = self._cached_result(key)
+        if cached is not None:
+            return cached.copy()
 
-        for topic in all_topics:
-            topic_row = []
-            for date in date_range:
-                count = self.topic_frequencies[topic].get(date, 0)
-                topic_row.append(count)
-            report_data[topic] = topic_row
-
-        # Create DataFrame
-        df = pd.DataFrame(report_data, index=date_range).T
+        # Generate date range
+        start_day = end_day - lookback_days
+        date_range = _date_strs(start_day, end_day)
+
+        # Sort all topics by total frequency (descending) before building the window
+        totals = self._window_sums(start_day, end_day)
+        rows = np.argsort(-totals, kind='stable')
+
+        # Copy the stored days into the report window; other days stay zero
+        window = np.zeros((len(rows), len(date_range)), dtype=COUNT_DTYPE)
+        cols = self._columns(start_day, end_day)
+        if cols.stop > cols.start:
+            offset = self.first_day - start_day + cols.start
+            window[:, offset:offset + cols.stop - cols.start] = self.counts[rows, cols]
+
+        # Create DataFrame directly from the window
+        df = pd.DataFrame(window, index=[self.topics[i] for i in rows], columns=date_range)
         df.index.name = 'Topic'
 
-        # Sort by total frequency (descending)
-        df['Total'] = df.sum(axis=1)
-        df = df.sort_values('Total', ascending=False)
-        df = df.drop('Total', axis=1)
-
-        return df
+        self._results[key] = df
+        return df.copy()
 
     def get_trending_topics(
             self,
             target_date: datetime,
             lookback_days: int = 30,
-            top_n: int = 10
-    ) -> List[Dict]:
+            top_n: int = 10,
+            as_frame: bool = False
+    ) -> Union[List[Dict], pd.DataFrame]:
         """
         Get the top trending topics
 
@@ -94,43 +276,41 @@ class TrendAnalyzer:
             target_date: End date for analysis
             lookback_days: Number of days to analyze
             top_n: Number of top topics to return
+            as_frame: Return a DataFrame with one row per topic instead of dictionaries
 
         Returns:
-            List of dictionaries with topic and frequency info
+            List of dictionaries (or DataFrame) with topic and frequency info
         """
-        start_date = target_date - timedelta(days=lookback_days)
+        end_day = target_date.toordinal()
+        key = ('trending', end_day, lookback_days, top_n)
+        trending = self._cached_result(key)
 
-        topic_totals = {}
+        if trending is None:
+            totals = self._window_sums(end_day - lookback_days, end_day)
 
-        for topic, dates in self.topic_frequencies.items():
-            total = 0
-            current = start_date
-            while current <= target_date:
-                date_str = current.strftime('%Y-%m-%d')
-                total += dates.get(date_str, 0)
-                current += timedelta(days=1)
+            idx = np.flatnonzero(totals > 0)
 
-            if total > 0:
-                topic_totals[topic] = total
+            # Partially sort to find the N-th largest total, keep every topic
+            # reaching it so ties at the cutoff stay in row order, then order just those
+            if 0 < top_n < len(idx):
+                cutoff = np.partition(totals[idx], len(idx) - top_n)[len(idx) - top_n]
+                idx = idx[totals[idx] >= cutoff]
+            idx = idx[np.argsort(-totals[idx], kind='stable')][:top_n]
 
-        # Sort and get top N
-        sorted_topics = sorted(
-            topic_totals.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:top_n]
+            trending = self._results[key] = pd.DataFrame({
+                'topic': [self.topics[i] for i in idx],
+                'frequency': totals[idx]
+            })
 
-        return [
-            {'topic': topic, 'frequency': freq}
-            for topic, freq in sorted_topics
-        ]
+        return trending.copy() if as_frame else trending.to_dict('records')
 
     def get_emerging_topics(
             self,
             target_date: datetime,
             recent_days: int = 7,
-            older_days: int = 23
-    ) -> List[Dict]:
+            older_days: int = 23,
+            as_frame: bool = False
+    ) -> Union[List[Dict], pd.DataFrame]:
         """
         Identify emerging topics (more frequent recently vs earlier)
 
@@ -138,55 +318,55 @@ class TrendAnalyzer:
             target_date: End date for analysis
             recent_days: Days to consider as "recent"
             older_days: Days to consider as "older" period
+            as_frame: Return a DataFrame with one row per topic instead of dictionaries
 
         Returns:
-            List of emerging topics with growth metrics
-        """
-        recent_start = target_date - timedelta(days=recent_days - 1)
-        older_start = target_date - timedelta(days=recent_days + older_days - 1)
-        older_end = target_date - timedelta(days=recent_days)
-
-        emerging = []
-
-        for topic, dates in self.topic_frequencies.items():
-            # Calculate recent frequency
-            recent_freq = 0
-            current = recent_start
-            while current <= target_date:
-                date_str = current.strftime('%Y-%m-%d')
-                recent_freq += dates.get(date_str, 0)
-                current += timedelta(days=1)
-
-            # Calculate older frequency
-            older_freq = 0
-            current = older_start
-            while current <= older_end:
-                date_str = current.strftime('%Y-%m-%d')
-                older_freq += dates.get(date_str, 0)
-                current += timedelta(days=1)
-
-            # Calculate growth
-            if older_freq > 0:
-                growth_rate = (recent_freq - older_freq) / older_freq
-                if growth_rate > 0.5:  # 50% increase
-                    emerging.append({
-                        'topic': topic,
-                        'recent_frequency': recent_freq,
-                        'older_frequency': older_freq,
-                        'growth_rate': growth_rate
-                    })
-            elif recent_freq >= 3:  # New topic with decent volume
-                emerging.append({
-                    'topic': topic,
-                    'recent_frequency': recent_freq,
-                    'older_frequency': 0,
-                    'growth_rate': float('inf')
-                })
+            List of emerging topics (or DataFrame) with growth metrics
+        """
+        end_day = target_date.toordinal()
+        recent_start = end_day - (recent_days - 1)
+        older_start = end_day - (recent_days + older_days - 1)
+        older_end = end_day - recent_days
+
+        if njit is not None:
+            recent_cols = self._columns(recent_start, end_day)
+            older_cols = self._columns(older_start, older_end)
+            cum = self._prefix_sums()
+
+            n_topics = cum.shape[0]
+            recent = np.empty(n_topics, dtype=np.int64)
+            older = np.empty(n_topics, dtype=np.int64)
+            growth = np.empty(n_topics, dtype=np.float64)
+            mask = np.empty(n_topics, dtype=np.bool_)
+            _emerging_kernel(
+                cum, recent_cols.start, recent_cols.stop, older_cols.start, older_cols.stop,
+                recent, older, growth, mask
+            )
+        else:
+            # Calculate recent and older frequencies of every topic
+            recent = self._window_sums(recent_start, end_day)
+            older = self._window_sums(older_start, older_end)
+
+            # Calculate growth; topics new in the recent window grow infinitely
+            with np.errstate(divide='ignore', invalid='ignore'):
+                growth = np.where(older > 0, (recent - older) / older, np.inf)
+
+            # 50% increase, or a new topic with decent volume
+            mask = ((older > 0) & (growth > 0.5)) | ((older == 0) & (recent >= 3))
+
+        idx = np.flatnonzero(mask)
 
         # Sort by growth rate
-        emerging.sort(key=lambda x: x['growth_rate'], reverse=True)
+        idx = idx[np.argsort(-growth[idx], kind='stable')]
+
+        emerging = pd.DataFrame({
+            'topic': [self.topics[i] for i in idx],
+            'recent_frequency': recent[idx],
+            'older_frequency': older[idx],
+            'growth_rate': growth[idx]
+        })
 
-        return emerging
+        return emerging if as_frame else emerging.to_dict('records')
 
     def export_to_csv(self, df: pd.DataFrame, output_path: str):
         """
@@ -196,5 +376,10 @@ class TrendAnalyzer:
             df: DataFrame to export
             output_path: Path to save CSV file
         """
-        df.to_csv(output_path)
+        if pa is not None:
+            # Arrow's C++ writer; strings are quoted, numbers are not
+            table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+            pa_csv.write_csv(table, output_path, pa_csv.WriteOptions(quoting_style='needed'))
+        else:
+            df.to_csv(output_path)
         print(f"Trend report exported to {output_path}")
\ No newline at end of file